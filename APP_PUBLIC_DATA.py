@@ -1,16 +1,21 @@
 import streamlit as st
 import geopandas as gpd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import folium
 from streamlit_folium import st_folium
-from shapely.geometry import Point, MultiPoint
+import shapely
+from shapely.geometry import Point
+from pyproj import Transformer
 import plotly.express as px
 import plotly.graph_objects as go
 import plotly.io as pio
-from io import BytesIO
-import json
 import pandas as pd
+import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 
 # --- Configuración de la Página ---
 st.set_page_config(
@@ -33,8 +38,147 @@ A través de una experiencia interactiva, recorrerás paso a paso el proceso de
 _Convierte los datos en visión. Descubre el potencial oculto de cada rincón de Bogotá. El análisis comienza aquí._
 """)
 
+# CRS métrico para Bogotá (MAGNA-SIRGAS / Colombia Bogotá), usado en los buffers
+CRS_METRICO = "EPSG:3116"
+
+# Tolerancias de simplificación (grados) de las capas poligonales, solo para dibujarlas
+TOLERANCIA_SIMPLIFICACION = {
+    "localidades": 5e-4,   # Solo se ve completa a zoom 11
+    "manzanas": 5e-5       # ~5 m, imperceptible a zoom 14
+}
+
+# Atributos que usa la aplicación en cada capa; el resto se descarta al cargar
+COLUMNAS_UTILES = {
+    "localidades": ["nombre_localidad", "num_localidad"],
+    "areas": ["id_area", "uso_pot_simplificado"],
+    "manzanas": ["estrato", "id_area"],
+    "transporte": ["nombres"],
+    "colegios": ["nombres"]
+}
+
+# --- Estilos unificados de los mapas Folium ---
+# Mapa de selección de localidad
+COLOR_FRAME = "#131313"        # Marco general, negro-gris
+COLOR_FILL = "#3D8EDB"         # Relleno principal, azul corporativo
+COLOR_HI_FILL = "#E7F5FF"      # Relleno al hover, azul muy claro
+COLOR_BORDER = "#C22323"       # Borde destacado en hover, rojo intenso
+
+# Mapa de selección del punto dentro de la localidad
+COLOR_FILL_SEL = "#E4EB83"     # Relleno claro
+COLOR_HI_FILL_SEL = "#F7C28E"  # Relleno al hover, naranja suave
+COLOR_BORDER_SEL = "#FF0000"   # Borde rojo
+
+ESTILO_LOCALIDAD = {
+    "fillColor": COLOR_FILL,
+    "color": COLOR_FRAME,
+    "weight": 2,
+    "fillOpacity": 0.35,       # Un poco más visible
+}
+RESALTADO_LOCALIDAD = {
+    "weight": 3,
+    "color": COLOR_BORDER,
+    "fillColor": COLOR_HI_FILL,
+    "fillOpacity": 0.55,
+}
+ESTILO_LOCALIDAD_SEL = {
+    "fillColor": COLOR_FILL_SEL,
+    "color": COLOR_BORDER_SEL,
+    "weight": 3,
+    "fillOpacity": 0.35,
+    "interactive": True
+}
+RESALTADO_LOCALIDAD_SEL = {
+    "fillColor": COLOR_HI_FILL_SEL,
+    "color": COLOR_BORDER_SEL,
+    "weight": 4,
+    "fillOpacity": 0.45
+}
+
+# CSS para cursor de cruz. Va dentro del HTML del mapa: st_folium lo dibuja en
+# un iframe al que no llegan los estilos de la página de Streamlit
+CURSOR_CRUZ_CSS = """
+<style>
+    .folium-map, .leaflet-container, .leaflet-interactive, .leaflet-grab {
+        cursor: crosshair !important;
+    }
+    .leaflet-dragging .leaflet-grab {
+        cursor: move !important;
+    }
+</style>
+"""
+
+# --- Colores de los mapas del diagnóstico ---
+# Fijos para toda la ciudad: un estrato o uso conserva su color en cualquier zona
+COLOR_ESTRATO = {
+    1: '#8B0000',  # Rojo oscuro
+    2: '#FF4500',  # Rojo naranja
+    3: '#FFD700',  # Dorado
+    4: '#90EE90',  # Verde claro
+    5: '#4169E1',  # Azul real
+    6: '#9370DB'   # Púrpura medio
+}
+PALETA_POT = px.colors.qualitative.Plotly
+
+
+def estilo_localidad(feature):
+    """Estilo base de cada localidad en el mapa de selección"""
+    return ESTILO_LOCALIDAD
+
+
+def resaltado_localidad(feature):
+    """Estilo al pasar el mouse sobre una localidad"""
+    return RESALTADO_LOCALIDAD
+
+
+def estilo_localidad_sel(feature):
+    """Estilo base de la localidad elegida en el mapa del punto"""
+    return ESTILO_LOCALIDAD_SEL
+
+
+def resaltado_localidad_sel(feature):
+    """Estilo al pasar el mouse sobre la localidad elegida"""
+    return RESALTADO_LOCALIDAD_SEL
+
+# --- Sesión HTTP compartida: keep-alive y reintentos ante fallos transitorios ---
+@st.cache_resource
+def obtener_sesion_http():
+    """Crea una única sesión HTTP con reintentos para descargar los datasets"""
+    sesion = requests.Session()
+    reintentos = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    sesion.mount("https://", HTTPAdapter(max_retries=reintentos))
+    return sesion
+
+# --- Puntos planos: un Point por fila con su propio nombre ---
+def explotar_puntos(gdf, nombre_defecto):
+    """Aplana los MultiPoint en un punto por fila, cada uno con su propio nombre"""
+    puntos = gdf.explode(index_parts=True)
+    puntos = puntos[puntos.geom_type == "Point"]
+    filas = puntos.index.get_level_values(0)
+
+    # Varios puntos por fila comparten la lista "a; b; c": a cada parte su nombre,
+    # o el primero si la lista es más corta que el número de puntos
+    if "nombres" in gdf.columns:
+        nombres = gdf["nombres"].fillna(nombre_defecto).astype(str).str.split(";").explode().str.strip()
+        nombres.index = pd.MultiIndex.from_arrays([nombres.index, nombres.groupby(level=0).cumcount()])
+        primeros = nombres.xs(0, level=1)
+        nombre = nombres.reindex(puntos.index).fillna(
+            pd.Series(primeros.reindex(filas).to_numpy(), index=puntos.index)
+        )
+    else:
+        nombre = nombre_defecto
+    puntos = puntos.assign(
+        nombre=nombre,
+        x=puntos.geometry.x,
+        y=puntos.geometry.y
+    )
+    # Un punto repetido en varias filas cuenta una sola vez: se descarta aquí,
+    # una vez, en lugar de en cada consulta
+    puntos = puntos.drop_duplicates(subset=["x", "y"])
+    return puntos[["nombre", "x", "y", "geometry"]].reset_index(drop=True)
+
 # --- Función cacheada para la carga de datos ---
-@st.cache_data
+# La caché se persiste en disco para sobrevivir a reinicios del servidor
+@st.cache_data(persist="disk", max_entries=2, show_spinner=False)
 def cargar_datasets():
     """Carga los datasets geográficos urbanos desde fuentes abiertas"""
     datasets = {
@@ -45,95 +189,100 @@ def cargar_datasets():
         "colegios": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_colegios.geojson"
     }
     dataframes = {}
-    for nombre, url in datasets.items():
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        geojson_data = json.loads(response.text)
-        dataframes[nombre] = gpd.GeoDataFrame.from_features(
-            geojson_data["features"], crs="EPSG:4326"
-        )
+    sesion = obtener_sesion_http()
+    # Descargas en paralelo: el tiempo total es el de la descarga más lenta
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        futuros = {
+            executor.submit(sesion.get, url, timeout=30): nombre
+            for nombre, url in datasets.items()
+        }
+        for futuro in as_completed(futuros):
+            nombre = futuros[futuro]
+            response = futuro.result()
+            response.raise_for_status()
+            # Lectura en C vía GDAL/pyogrio directamente desde los bytes descargados
+            gdf = gpd.read_file(response.content, engine="pyogrio")
+            columnas = [c for c in COLUMNAS_UTILES[nombre] if c in gdf.columns]
+            gdf = gdf[columnas + [gdf.geometry.name]]
+            # Todas las capas quedan en WGS84 (lo que esperan Folium y Plotly);
+            # los análisis en metros usan las copias *_m / *_pts
+            if gdf.crs is None:
+                gdf = gdf.set_crs("EPSG:4326")
+            elif gdf.crs.to_epsg() != 4326:
+                gdf = gdf.to_crs("EPSG:4326")
+            dataframes[nombre] = gdf
+
+    # Copia métrica de las localidades para los conteos por localidad. Las
+    # capas poligonales se conservan completas para el análisis y se
+    # simplifican solo al dibujarlas
+    dataframes["localidades_m"] = dataframes["localidades"].to_crs(CRS_METRICO)
+
+    # Estaciones y colegios aplanados una sola vez: el paso 5 y el informe
+    # trabajan directamente sobre Points, sin explotar MultiPoints por rerun.
+    # La geometría queda en metros; x / y conservan lon / lat para los mapas
+    dataframes["transporte_pts"] = explotar_puntos(dataframes["transporte"], "Estación sin nombre").to_crs(CRS_METRICO)
+    dataframes["colegios_pts"] = explotar_puntos(dataframes["colegios"], "Colegio sin nombre").to_crs(CRS_METRICO)
+
+    # Copia proyectada una sola vez para los análisis en metros
+    dataframes["manzanas_m"] = dataframes["manzanas"].to_crs(CRS_METRICO)
     return dataframes
 
-# --- Inicialización del estado ---
-if "step" not in st.session_state:
-    st.session_state.step = 1
-
-# ========================================
-# PASO 1: CARGA DE DATOS
-# ========================================
-if st.session_state.step == 1:
-    st.markdown("""
-    ### 🚦 Punto de partida: Activando el diagnóstico urbano
-
-    Antes de comenzar, el sistema recopila y verifica los datos esenciales de la ciudad para tu análisis.
-    Este proceso conectará fuentes oficiales y consolidará información geoespacial clave para que tu exploración territorial sea sólida y confiable.
-    """)
-    
-    st.info(
-        "🔄 **Preparando el escenario digital:**\n\n"
-        "En segundos tendrás acceso a la radiografía inteligente de Bogotá, utilizando fuentes oficiales de datos abiertos urbanísticos."
+# --- Serialización cacheada de capas para Folium ---
+# Los GeoDataFrame no son hasheables: la caché se indexa con una clave explícita
+@st.cache_data(show_spinner=False)
+def serializar_geojson(clave, _gdf):
+    """Convierte un GeoDataFrame a texto GeoJSON una sola vez por clave"""
+    return _gdf.to_json()
+
+
+@st.cache_resource
+def simplificar_localidades(_localidades):
+    """Localidades con menos vértices, solo para dibujarlas en los mapas"""
+    # Menos vértices que serializar y dibujar, sin cambio visible en el mapa, y
+    # solo la propiedad que muestra el tooltip en el GeoJSON enviado a Leaflet
+    return gpd.GeoDataFrame(
+        {"nombre_localidad": _localidades["nombre_localidad"]},
+        geometry=_localidades.geometry.simplify(TOLERANCIA_SIMPLIFICACION["localidades"], preserve_topology=True),
+        crs=_localidades.crs
     )
 
-    # Usar spinner para indicar proceso de carga
-    with st.spinner('⏳ Conectando y descargando los datasets urbanos...'):
-        try:
-            dataframes = cargar_datasets()
-        except Exception as e:
-            st.error(f"❌ Error al cargar los datos: {e}")
-            st.stop()
-
-    if dataframes:
-        st.success('✅ Datos cargados exitosamente. ¡Listo para iniciar tu análisis!')
-        if st.button("🔍 Empezar diagnóstico"):
-            for nombre, df in dataframes.items():
-                st.session_state[nombre] = df
-            st.session_state.step = 2
-            st.rerun()
-    else:
-        st.error("❌ Ocurrió un problema al cargar los datos. Verifica tu conexión o inténtalo nuevamente en unos minutos.")
-
 
-# ========================================
-# PASO 2: SELECCIÓN DE LOCALIDAD
-# ========================================
-elif st.session_state.step == 2:
-    st.header("🌆 Paso 1: Selecciona tu Localidad de Interés")
-
-    st.markdown("""
-    **¿Dónde comienza tu análisis?**
-    Haz clic sobre la localidad de Bogotá que deseas explorar. El sistema te mostrará un mapa interactivo con límites administrativos oficiales.
-    El color azul suave resalta el área elegida; al pasar el mouse, el borde rojo reforzará tu selección. Toda la plataforma mantiene un estilo gráfico uniforme para garantizar claridad y profesionalismo.
-    """)
+@st.cache_data(show_spinner=False)
+def indice_localidades(_localidades):
+    """Diccionario nombre → (código, posición) de las localidades, construido una vez"""
+    return {
+        nombre: (codigo, posicion)
+        for posicion, (nombre, codigo) in enumerate(
+            zip(_localidades["nombre_localidad"], _localidades["num_localidad"])
+        )
+    }
 
-    # Estilos generales unificados para todas las visualizaciones
-    COLOR_FRAME = "#131313"        # Marco general, negro-gris
-    COLOR_FILL = "#3D8EDB"         # Relleno principal, azul corporativo
-    COLOR_HI_FILL = "#E7F5FF"      # Relleno al hover, azul muy claro
-    COLOR_BORDER = "#C22323"       # Borde destacado en hover, rojo intenso
 
-    localidades = st.session_state.localidades
+@st.cache_data(show_spinner=False)
+def calcular_centro(clave, _geometria):
+    """Centro (lat, lon) del rectángulo que envuelve las geometrías, una sola vez por clave"""
+    # Directamente en shapely: sirve para un arreglo de geometrías o un solo polígono
+    minx, miny, maxx, maxy = shapely.total_bounds(_geometria)
+    return (float((miny + maxy) / 2), float((minx + maxx) / 2))
 
-    # Crear mapa interactivo con Folium
-    bounds = localidades.total_bounds
-    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
+# --- Mapas base ---
+# Un Map por sesión y por ejecución completa: st_folium modifica el Map al
+# renderizarlo, así que no se comparte entre sesiones. El GeoJSON y el
+# centro ya llegan cacheados, y el fragmento lo reutiliza entre clics
+def construir_mapa_localidades(geojson_localidades, centro):
+    """Construye el mapa Folium de selección de localidad"""
+    mapa = folium.Map(
+        location=list(centro),
+        zoom_start=11,
+        tiles="CartoDB positron",
+        prefer_canvas=True
+    )
 
-    mapa = folium.Map(location=center, zoom_start=11, tiles="CartoDB positron")
-    
     # Marco y estilos de localidad
     folium.GeoJson(
-        localidades,
-        style_function=lambda feature: {
-            "fillColor": COLOR_FILL,
-            "color": COLOR_FRAME,
-            "weight": 2,
-            "fillOpacity": 0.35,       # Un poco más visible
-        },
-        highlight_function=lambda feature: {
-            "weight": 3,
-            "color": COLOR_BORDER,
-            "fillColor": COLOR_HI_FILL,
-            "fillOpacity": 0.55,
-        },
+        geojson_localidades,
+        style_function=estilo_localidad,
+        highlight_function=resaltado_localidad,
         tooltip=folium.GeoJsonTooltip(
             fields=["nombre_localidad"],
             aliases=["Localidad:"],
@@ -141,20 +290,56 @@ elif st.session_state.step == 2:
             sticky=True
         )
     ).add_to(mapa)
+    return mapa
+
+
+def construir_mapa_punto(geojson_localidad, centro):
+    """Construye el mapa Folium de selección del punto sobre la localidad elegida"""
+    mapa = folium.Map(
+        location=list(centro),
+        zoom_start=12,
+        tiles="CartoDB positron",
+        prefer_canvas=True
+    )
+
+    # Polígono de localidad visual uniforme
+    folium.GeoJson(
+        geojson_localidad,
+        style_function=estilo_localidad_sel,
+        highlight_function=resaltado_localidad_sel
+    ).add_to(mapa)
+
+    # CSS para cursor de cruz
+    mapa.get_root().html.add_child(folium.Element(CURSOR_CRUZ_CSS))
+    return mapa
 
+# --- Fragmentos de mapa: un clic solo vuelve a ejecutar este bloque ---
+@st.fragment
+def fragmento_mapa_localidades(mapa, localidades):
+    """Mapa de selección de localidad con captura del clic"""
     # Uniformidad en tamaño del lienzo para todas las visualizaciones
-    result = st_folium(mapa, width=900, height=600, returned_objects=["last_clicked"])
+    result = st_folium(
+        mapa, width=900, height=600, returned_objects=["last_clicked"], key="mapa_localidades"
+    )
 
     # Detectar clic en localidad
     clicked = result.get("last_clicked")
-    if clicked and "lat" in clicked and "lng" in clicked:
+    # last_clicked persiste entre reruns: solo se busca la localidad si el clic es nuevo
+    if (
+        clicked and "lat" in clicked and "lng" in clicked
+        and (clicked["lat"], clicked["lng"]) != st.session_state.get("_last_click_key")
+    ):
+        st.session_state._last_click_key = (clicked["lat"], clicked["lng"])
         punto = Point(clicked["lng"], clicked["lat"])
-        for _, row in localidades.iterrows():
-            if row["geometry"].contains(punto):
-                st.session_state.localidad_clic = row["nombre_localidad"]
-                break
-        else:
-            st.session_state.localidad_clic = None
+        # El índice espacial (R-tree) descarta por rectángulo y los polígonos
+        # preparados resuelven la pertenencia exacta de los candidatos
+        candidatos = localidades.sindex.query(punto)
+        idx = candidatos[shapely.contains_xy(
+            localidades.geometry.values[candidatos], clicked["lng"], clicked["lat"]
+        )]
+        st.session_state.localidad_clic = (
+            localidades["nombre_localidad"].iloc[idx[0]] if len(idx) else None
+        )
 
     # Mostrar localidad seleccionada
     if "localidad_clic" in st.session_state and st.session_state.localidad_clic:
@@ -162,129 +347,20 @@ elif st.session_state.step == 2:
         if st.button("✅ Confirmar y Continuar"):
             st.session_state.localidad_sel = st.session_state.localidad_clic
             st.session_state.step = 3
-            st.rerun()
-
-    st.markdown("---")
-    if st.button("🔄 Volver al Inicio"):
-        st.session_state.step = 1
-        st.rerun()
-
-
-# ========================================
-# PASO 3: DEFINIR ÁREA DE INFLUENCIA
-# ========================================
-elif st.session_state.step == 3:
-    st.header("📏 Paso 2: Define el radio de tu análisis urbano")
-
-    st.markdown(f"""
-    **Localidad seleccionada:** `{st.session_state.localidad_sel}`  
-    
-    El radio de análisis determina el área de influencia que se estudiará alrededor del punto que escojas en el mapa.
-    Decide qué tan amplio quieres que sea tu contexto urbano y ajusta el valor en metros para comparar sectores de forma homogénea.
-    """)
-
-    # Saltos de 300 en 300 para mejor usabilidad mobile/desktop
-    radio_analisis = st.slider(
-        "Selecciona el radio de análisis (metros)",
-        min_value=300,
-        max_value=2100,
-        value=600,
-        step=300,
-        help="Entre más grande el radio, más contexto y servicios urbanos tendrás en el análisis."
-    )
-    st.session_state.radio_analisis = radio_analisis
-
-    st.info(f"🟠 El análisis incluirá una zona de **{radio_analisis} metros** alrededor del punto que selecciones en el siguiente paso.")
-
-    # Botones de navegación
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("🔙 Volver a selección de localidad"):
-            st.session_state.step = 2
-            st.rerun()
-    with col2:
-        if st.button("➡️ Continuar"):
-            st.session_state.step = 4
-            st.rerun()
-
-
-# ========================================
-# PASO 4: SELECCIÓN DE PUNTO DE INTERÉS
-# ========================================
-elif st.session_state.step == 4:
-    st.header("📍 Paso 3: Selecciona el punto sobre el cual analizarás el entorno")
-
-    st.markdown(f"""
-    **Localidad elegida:** `{st.session_state.localidad_sel}`  
-    **Radio de análisis:** `{st.session_state.radio_analisis} metros`
-
-    Haz clic directamente sobre la zona que deseas estudiar en detalle. 
-    El sistema aplicará el radio seleccionado para analizar el entorno urbano alrededor del punto que escojas.
-    """)
-
-    localidades = st.session_state.localidades
-
-    # Filtrar por localidad seleccionada
-    cod_localidad = localidades[
-        localidades["nombre_localidad"] == st.session_state.localidad_sel
-    ]["num_localidad"].values[0]
+            st.rerun()  # Desde un fragmento, relanza la aplicación completa
 
-    localidad_geo = localidades[localidades["num_localidad"] == cod_localidad]
-
-    # Colores uniformes
-    COLOR_FILL = "#E4EB83"  # Relleno claro
-    COLOR_BORDER = "#FF0000"  # Borde rojo
-
-    # Crear mapa con cursor cruz
-    bounds = localidad_geo.total_bounds
-    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
-
-    mapa = folium.Map(
-        location=center,
-        zoom_start=12,
-        tiles="CartoDB positron",
-        prefer_canvas=True
-    )
-
-    # Polígono de localidad visual uniforme
-    folium.GeoJson(
-        localidad_geo,
-        style_function=lambda feature: {
-            "fillColor": COLOR_FILL,
-            "color": COLOR_BORDER,
-            "weight": 3,
-            "fillOpacity": 0.35,
-            "interactive": True
-        },
-        highlight_function=lambda feature: {
-            "fillColor": "#F7C28E",
-            "color": COLOR_BORDER,
-            "weight": 4,
-            "fillOpacity": 0.45
-        }
-    ).add_to(mapa)
-
-    # CSS para cursor de cruz
-    cursor_css = """
-    <style>
-        .folium-map, .leaflet-container, .leaflet-interactive, .leaflet-grab {
-            cursor: crosshair !important;
-        }
-        .leaflet-dragging .leaflet-grab {
-            cursor: move !important;
-        }
-    </style>
-    """
-    mapa.get_root().html.add_child(folium.Element(cursor_css))
 
+@st.fragment
+def fragmento_mapa_punto(mapa):
+    """Mapa de selección del punto de interés con captura del clic"""
     # Renderizar mapa interactivo
     result = st_folium(mapa, width=900, height=600, returned_objects=["last_clicked"], key="mapa_punto_interes")
 
     # Captura clic y muestra detalles con storytelling
     clicked = result.get("last_clicked")
     if clicked and "lat" in clicked and "lng" in clicked:
-        st.session_state.punto_lat = clicked["lat"]
-        st.session_state.punto_lon = clicked["lng"]
+        # Un solo valor en la sesión: (lat, lon) como floats
+        st.session_state.punto = (float(clicked["lat"]), float(clicked["lng"]))
 
         st.success(
             f"📍 Punto seleccionado correctamente. "
@@ -305,142 +381,211 @@ elif st.session_state.step == 4:
     else:
         st.info("👆 Haz clic sobre el mapa para elegir tu punto de estudio.")
 
-    st.markdown("---")
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("🔙 Volver al paso anterior", use_container_width=True):
-            st.session_state.step = 3
-            st.rerun()
-    with col2:
-        if st.button("🔄 Reiniciar análisis", use_container_width=True):
-            st.session_state.step = 1
-            st.rerun()
+# --- Utilidades espaciales para el diagnóstico ---
+@st.cache_resource
+def obtener_transformador():
+    """Transformador WGS84 → sistema métrico, creado una sola vez"""
+    return Transformer.from_crs("EPSG:4326", CRS_METRICO, always_xy=True)
+
+
+@st.cache_resource
+def obtener_arbol(clave, _geometrias):
+    """STRtree de una capa estática, construido una vez y compartido entre sesiones"""
+    return shapely.STRtree(_geometrias)
+
+
+@st.cache_resource
+def obtener_coordenadas(clave, _geometrias):
+    """Coordenadas x/y de una capa de puntos como arreglos contiguos, extraídas una vez"""
+    coords = shapely.get_coordinates(_geometrias)
+    return np.ascontiguousarray(coords[:, 0]), np.ascontiguousarray(coords[:, 1])
+
+
+def puntos_en_area(clave, puntos, area):
+    """Filtra en una sola llamada vectorizada los puntos dentro del área"""
+    xs, ys = obtener_coordenadas(clave, puntos.geometry.values)
+    return puntos[shapely.contains_xy(area, xs, ys)]
+
+@st.cache_data(show_spinner=False)
+def obtener_colores_pot(_areas):
+    """Asigna un color a cada uso POT de la ciudad, una sola vez"""
+    usos = sorted(set(_areas["uso_pot_simplificado"].dropna()) | {"Sin clasificación"})
+    return {uso: PALETA_POT[i % len(PALETA_POT)] for i, uso in enumerate(usos)}
+
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def calcular_diagnostico(lat, lon, radio, cod_localidad, _manzanas, _manzanas_m, _transporte_pts, _colegios_pts, _areas):
+    """Núcleo analítico del paso 5, cacheado por punto, radio y localidad"""
+    # Crear punto y área de análisis directamente en metros; solo el borde
+    # del buffer vuelve a WGS84 para dibujarlo
+    transformador = obtener_transformador()
+    area_proj = Point(transformador.transform(lon, lat)).buffer(radio)
+    # Preparado una vez y reutilizado por las tres consultas espaciales
+    shapely.prepare(area_proj)
+    borde_x, borde_y = area_proj.exterior.xy
+    # Coordenadas del borde en WGS84, calculadas una vez para los cuatro mapas;
+    # en float32 viajan al navegador con la mitad de bytes
+    borde_lon, borde_lat = transformador.transform(
+        np.asarray(borde_x), np.asarray(borde_y), direction="INVERSE"
+    )
+    borde_lon, borde_lat = borde_lon.astype(np.float32), borde_lat.astype(np.float32)
+
+    # Filtrar datos dentro del área de análisis: el índice espacial (sobre la
+    # copia métrica) solo evalúa las manzanas cuyo rectángulo toca el buffer
+    manzanas_zona = _manzanas.iloc[
+        _manzanas_m.sindex.query(area_proj, predicate="intersects")
+    ]
+    # Geometría aligerada solo para los mapas; los conteos no dependen de ella
+    manzanas_zona = manzanas_zona.assign(
+        geometry=manzanas_zona.geometry.simplify(TOLERANCIA_SIMPLIFICACION["manzanas"], preserve_topology=True)
+    )
 
-# ========================================
-# PASO 5: GENERACIÓN DE MAPAS Y ANÁLISIS
-# ========================================
-elif st.session_state.step == 5:
-    st.header("📊 Diagnóstico Urbano Completo")
+    # Estaciones y colegios dentro del área de análisis: el STRtree compartido
+    # devuelve directamente los puntos contenidos en el buffer
+    arbol_transporte = obtener_arbol("transporte_pts", _transporte_pts.geometry.values)
+    arbol_colegios = obtener_arbol("colegios_pts", _colegios_pts.geometry.values)
+    estaciones_area = _transporte_pts.iloc[arbol_transporte.query(area_proj, predicate="contains")]
+    colegios_area = _colegios_pts.iloc[arbol_colegios.query(area_proj, predicate="contains")]
 
-    st.markdown(f"""
-    <b>Localidad seleccionada:</b> {st.session_state.localidad_sel}  
-    <b>Radio de análisis:</b> {st.session_state.radio_analisis} metros  
-    <b>Punto de interés:</b> Lat {st.session_state.punto_lat:.6f}, Lon {st.session_state.punto_lon:.6f}
+    # Unificar con áreas POT de la zona
+    if "id_area" in manzanas_zona.columns and not _areas.empty:
+        manzanas_pot = manzanas_zona.merge(
+            _areas[["id_area", "uso_pot_simplificado"]],
+            on="id_area",
+            how="left"
+        )
+        manzanas_pot["uso_pot_simplificado"] = manzanas_pot["uso_pot_simplificado"].fillna("Sin clasificación")
+    else:
+        manzanas_pot = manzanas_zona.copy()
+        manzanas_pot["uso_pot_simplificado"] = "Sin clasificación"
 
-    La herramienta generará visualizaciones y métricas que describen el entorno urbano alrededor del punto elegido. Analiza la densidad, acceso a servicios y el contexto socioespacial de la zona seleccionada.
-    """, unsafe_allow_html=True)
+    return {
+        "borde_lat": borde_lat,
+        "borde_lon": borde_lon,
+        "manzanas_zona": manzanas_zona,
+        "estaciones_area": estaciones_area,
+        "colegios_area": colegios_area,
+        "manzanas_pot": manzanas_pot,
+        "dist_estratos": manzanas_zona["estrato"].value_counts().sort_index(),
+        "dist_pot": manzanas_pot["uso_pot_simplificado"].value_counts()
+    }
 
-    # Cargar datos
-    localidades = st.session_state.localidades
-    manzanas = st.session_state.manzanas
-    transporte = st.session_state.transporte
-    colegios = st.session_state.colegios
-    areas = st.session_state.areas
+@st.cache_data(show_spinner=False)
+def totales_por_localidad(cod_localidad, _localidades_m, _transporte_pts, _colegios_pts):
+    """Estaciones y colegios de toda la localidad: solo dependen de la localidad"""
+    # Un solo contains_xy contra el polígono oficial de la localidad, sin
+    # unir sus manzanas ni construir Points
+    poligono = _localidades_m.loc[
+        _localidades_m["num_localidad"] == cod_localidad, "geometry"
+    ].iloc[0]
+    shapely.prepare(poligono)
+    return (
+        len(puntos_en_area("transporte_pts", _transporte_pts, poligono)),
+        len(puntos_en_area("colegios_pts", _colegios_pts, poligono))
+    )
 
-    # Obtener código de localidad
-    cod_localidad = localidades[
-        localidades["nombre_localidad"] == st.session_state.localidad_sel
-    ]["num_localidad"].values[0]
-
-    # Crear punto y área de análisis
-    punto = Point(st.session_state.punto_lon, st.session_state.punto_lat)
-    punto_gdf = gpd.GeoDataFrame([{"geometry": punto}], crs="EPSG:4326")
-    punto_proj = punto_gdf.to_crs(epsg=3116)
-    area_proj = punto_proj.buffer(st.session_state.radio_analisis)
-    area_wgs = area_proj.to_crs(epsg=4326).iloc[0]
-
-    # Filtrar datos dentro del área de análisis
-    manzanas_zona = manzanas[manzanas.geometry.intersects(area_wgs)]
-
-    # Contar estaciones de transporte dentro del área de análisis
-    estaciones_zona = []
-    for _, row in transporte.iterrows():
-        if hasattr(row["geometry"], "geoms"):
-            for pt in row["geometry"].geoms:
-                if area_wgs.contains(pt):
-                    estaciones_zona.append(pt)
-        elif isinstance(row["geometry"], Point):
-            if area_wgs.contains(row["geometry"]):
-                estaciones_zona.append(row["geometry"])
-
-    # Contar colegios dentro del área de análisis
-    colegios_zona = []
-    for _, row in colegios.iterrows():
-        if hasattr(row["geometry"], "geoms"):
-            for pt in row["geometry"].geoms:
-                if area_wgs.contains(pt):
-                    colegios_zona.append(pt)
-        elif isinstance(row["geometry"], Point):
-            if area_wgs.contains(row["geometry"]):
-                colegios_zona.append(row["geometry"])
+@st.cache_data(show_spinner=False, max_entries=20)
+def generar_informe(localidad, radio, lat, lon, n_manzanas, estrato_predominante, uso_predominante,
+                    n_estaciones, n_colegios, total_estaciones_loc, total_colegios_loc):
+    """Arma una sola vez el texto del informe, su puntaje y el CSV de descarga"""
+    # Calcular porcentajes
+    porcentaje_estaciones = (n_estaciones / total_estaciones_loc * 100) if total_estaciones_loc > 0 else 0
+    porcentaje_colegios = (n_colegios / total_colegios_loc * 100) if total_colegios_loc > 0 else 0
 
+    texto = f"""
+    #### Resumen Ejecutivo
     
- 
+    **Localidad Analizada:** {localidad}  
+    **Radio de Análisis:** {radio} metros  
+    **Coordenadas del Punto:** {lat:.6f}, {lon:.6f}
     
-    # ========================================
-    # VISUALIZACIÓN: MAPA DE ESTACIONES DE TRANSPORTE
-    # ========================================
-    st.markdown("""
-    ### 🚇 Accesibilidad en Transporte Público
-
-    En este mapa puedes visualizar todas las estaciones de transporte público dentro del área de análisis determinada. 
-    Cada punto rojo representa una estación disponible alrededor del punto seleccionado, ayudándote a entender la conectividad y accesibilidad de la zona.
+    ---
+    
+    #### 🏘️ Análisis de Manzanas
+    - **Total de manzanas en el buffer:** {n_manzanas}
+    - **Estrato predominante:** {estrato_predominante}
+    - **Uso del suelo predominante:** {uso_predominante}
+    
+    #### 🚇 Análisis de Transporte
+    - **Estaciones en el buffer:** {n_estaciones}
+    - **Total de estaciones en la localidad:** {total_estaciones_loc}
+    - **Representación:** {porcentaje_estaciones:.1f}% del total de la localidad
+    
+    **Diagnóstico:** {"✅ El sector cuenta con buena cobertura de transporte" if n_estaciones >= 2 else "⚠️ El sector tiene cobertura limitada de transporte"}
+    
+    #### 🏫 Análisis Educativo
+    - **Colegios en el buffer:** {n_colegios}
+    - **Total de colegios en la localidad:** {total_colegios_loc}
+    - **Representación:** {porcentaje_colegios:.1f}% del total de la localidad
+    
+    **Diagnóstico:** {"✅ El sector cuenta con buena oferta educativa" if n_colegios >= 2 else "⚠️ El sector tiene oferta educativa limitada"}
+    
+    #### 📊 Evaluación General
+    """
 
-    El área sombreada muestra el alcance del entorno estudiado, manteniendo la uniformidad estética en todos los mapas y métricas urbanas.
-    """)
+    # Evaluación general
+    score = 0
+    if n_estaciones >= 2:
+        score += 1
+    if n_colegios >= 2:
+        score += 1
+    if n_manzanas >= 10:
+        score += 1
 
-    # Detecta las estaciones dentro de la zona circular de análisis
-    estaciones_area = []
-    estaciones_coords = []
-    nombres_estaciones = []  # Nueva lista para almacenar nombres
+    # CSV con los datos, listo para el botón de descarga
+    csv_informe = pd.DataFrame({
+        "Indicador": ["Localidad", "Buffer (m)", "Manzanas", "Estaciones", "Colegios",
+                      "% Estaciones", "% Colegios"],
+        "Valor": [localidad, radio, n_manzanas, n_estaciones, n_colegios,
+                  f"{porcentaje_estaciones:.1f}", f"{porcentaje_colegios:.1f}"]
+    }).to_csv(index=False).encode("utf-8")
+
+    return texto, score, csv_informe
+
+def capa_manzanas(manzanas, nombre, color, grupo):
+    """Dibuja un grupo de manzanas como una sola traza coroplética de color uniforme"""
+    return go.Choroplethmapbox(
+        geojson=manzanas[["geometry"]].__geo_interface__,
+        locations=[str(i) for i in manzanas.index],  # ids de las features GeoJSON
+        z=[0] * len(manzanas),
+        colorscale=[[0, color], [1, color]],
+        showscale=False,
+        marker_line_color='black',
+        marker_line_width=0.5,
+        name=nombre,
+        showlegend=True,
+        legendgroup=grupo,
+        hovertext=nombre,
+        hoverinfo='text'
+    )
 
-    for _, row in transporte.iterrows():
-        geom = row["geometry"]
-        nombres_row = row.get("nombres", "Estación sin nombre")  # Obtener nombres de la fila
-        
-        # Separar nombres si hay múltiples estaciones (separadas por ";")
-        lista_nombres = [n.strip() for n in str(nombres_row).split(";")]
-        
-        # Manejar Multipoint y Point simple
-        if hasattr(geom, "geoms"):
-            for idx, pt in enumerate(geom.geoms):
-                if area_wgs.contains(pt):
-                    coord_tuple = (pt.x, pt.y)
-                    if coord_tuple not in estaciones_coords:
-                        estaciones_area.append(pt)
-                        estaciones_coords.append(coord_tuple)
-                        # Asignar nombre correspondiente o genérico si no hay suficientes
-                        nombre = lista_nombres[idx] if idx < len(lista_nombres) else lista_nombres[0]
-                        nombres_estaciones.append(nombre)
-        elif isinstance(geom, Point):
-            if area_wgs.contains(geom):
-                coord_tuple = (geom.x, geom.y)
-                if coord_tuple not in estaciones_coords:
-                    estaciones_area.append(geom)
-                    estaciones_coords.append(coord_tuple)
-                    nombres_estaciones.append(lista_nombres[0] if lista_nombres else "Estación")
+# --- Figuras del diagnóstico ---
+# Cacheadas por punto, radio y localidad: un rerun sin cambios no reconstruye
+# trazas ni GeoJSON. Las figuras se comparten entre sesiones y no se modifican
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_transporte(lat, lon, radio, cod_localidad, _diagnostico):
+    """Mapa de estaciones de transporte dentro del área de análisis"""
+    borde_lat, borde_lon = _diagnostico["borde_lat"], _diagnostico["borde_lon"]
+    estaciones_area = _diagnostico["estaciones_area"]
 
     fig_transporte = go.Figure()
 
     # Render destacado y uniforme del área
     fig_transporte.add_trace(go.Scattermapbox(
-        lat=list(area_wgs.exterior.xy[1]),
-        lon=list(area_wgs.exterior.xy[0]),
+        lat=borde_lat,
+        lon=borde_lon,
         mode='lines',
         fill='toself',
-        name=f'Área de análisis ({st.session_state.radio_analisis}m)',
+        name=f'Área de análisis ({radio}m)',
         fillcolor='rgba(255, 165, 0, 0.12)',
         line=dict(color='orange', width=2)
     ))
 
     # Los puntos de estaciones con nombres reales en el tooltip
-    if estaciones_area:
-        lats = [pt.y for pt in estaciones_area]
-        lons = [pt.x for pt in estaciones_area]
-
+    if not estaciones_area.empty:
         fig_transporte.add_trace(go.Scattermapbox(
-            lat=lats,
-            lon=lons,
+            lat=estaciones_area["y"].to_numpy(dtype=np.float32),
+            lon=estaciones_area["x"].to_numpy(dtype=np.float32),
             mode='markers',
             name='Estaciones de Transporte',
             marker=dict(
@@ -449,14 +594,14 @@ elif st.session_state.step == 5:
                 opacity=0.95,
                 symbol='circle'
             ),
-            text=nombres_estaciones,  # Usar nombres reales
+            text=estaciones_area["nombre"],  # Usar nombres reales
             hoverinfo='text'
         ))
 
     # Punto central seleccionado por el usuario
     fig_transporte.add_trace(go.Scattermapbox(
-        lat=[st.session_state.punto_lat],
-        lon=[st.session_state.punto_lon],
+        lat=[lat],
+        lon=[lon],
         mode='markers',
         name='Punto de interés',
         marker=dict(
@@ -467,90 +612,40 @@ elif st.session_state.step == 5:
 
     fig_transporte.update_layout(
         mapbox_style="carto-positron",
-        mapbox_center={"lat": st.session_state.punto_lat, "lon": st.session_state.punto_lon},
+        mapbox_center={"lat": lat, "lon": lon},
         mapbox_zoom=14,
         margin={"r": 0, "t": 40, "l": 0, "b": 0},
-        title=f"Estaciones de transporte público (radio {st.session_state.radio_analisis} m)",
+        title=f"Estaciones de transporte público (radio {radio} m)",
         showlegend=True,
         height=600
     )
+    return fig_transporte
 
-    st.plotly_chart(fig_transporte, use_container_width=True)
-
-    # Métricas visuales uniformes
-    col1, col2 = st.columns(2)
-    with col1:
-        st.metric("Estaciones en el entorno", len(estaciones_area))
-    with col2:
-        if estaciones_area:
-            densidad = len(estaciones_area) / (3.14159 * (st.session_state.radio_analisis / 1000) ** 2)
-            st.metric("Densidad de estaciones\n (por km²)", f"{densidad:.2f}")
-
-
-    # ========================================
-    # VISUALIZACIÓN: MAPA DE CENTROS EDUCATIVOS
-    # ========================================
-    st.markdown("""
-    ### 🏫 Oferta Educativa en el Entorno
-
-    Visualiza todos los centros educativos dentro del área de análisis que seleccionaste. 
-    Cada punto morado representa la ubicación de un colegio disponible para la comunidad, facilitando la evaluación de acceso educativo y nivel de cobertura del sector.
-
-    El área sombreada corresponde a los metros de radio definidos, manteniendo la uniformidad visual en toda la plataforma.
-    """)
-
-    # Detectar colegios dentro del área circular de análisis
-    colegios_area = []
-    colegios_coords = []
-    nombres_colegios = []  # Nueva lista para almacenar nombres
 
-    for _, row in colegios.iterrows():
-        geom = row["geometry"]
-        nombres_row = row.get("nombres", "Colegio sin nombre")  # Obtener nombres de la fila
-        
-        # Separar nombres si hay múltiples colegios (separados por ";")
-        lista_nombres = [n.strip() for n in str(nombres_row).split(";")]
-        
-        # Manejar MultiPoint y Point simple
-        if hasattr(geom, "geoms"):
-            for idx, pt in enumerate(geom.geoms):
-                if area_wgs.contains(pt):
-                    coord_tuple = (pt.x, pt.y)
-                    if coord_tuple not in colegios_coords:
-                        colegios_area.append(pt)
-                        colegios_coords.append(coord_tuple)
-                        # Asignar nombre correspondiente o genérico si no hay suficientes
-                        nombre = lista_nombres[idx] if idx < len(lista_nombres) else lista_nombres[0]
-                        nombres_colegios.append(nombre)
-        elif isinstance(geom, Point):
-            if area_wgs.contains(geom):
-                coord_tuple = (geom.x, geom.y)
-                if coord_tuple not in colegios_coords:
-                    colegios_area.append(geom)
-                    colegios_coords.append(coord_tuple)
-                    nombres_colegios.append(lista_nombres[0] if lista_nombres else "Colegio")
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_colegios(lat, lon, radio, cod_localidad, _diagnostico):
+    """Mapa de centros educativos dentro del área de análisis"""
+    borde_lat, borde_lon = _diagnostico["borde_lat"], _diagnostico["borde_lon"]
+    colegios_area = _diagnostico["colegios_area"]
 
     fig_educacion = go.Figure()
 
     # Área de análisis sombreada con estilo uniforme
     fig_educacion.add_trace(go.Scattermapbox(
-        lat=list(area_wgs.exterior.xy[1]),
-        lon=list(area_wgs.exterior.xy[0]),
+        lat=borde_lat,
+        lon=borde_lon,
         mode='lines',
         fill='toself',
-        name=f'Área de análisis ({st.session_state.radio_analisis}m)',
+        name=f'Área de análisis ({radio}m)',
         fillcolor='rgba(128, 0, 128, 0.07)',  # Morado muy suave
         line=dict(color='#6C3483', width=2)
     ))
 
     # Puntos de colegios con nombres reales en el tooltip
-    if colegios_area:
-        lats = [pt.y for pt in colegios_area]
-        lons = [pt.x for pt in colegios_area]
-
+    if not colegios_area.empty:
         fig_educacion.add_trace(go.Scattermapbox(
-            lat=lats,
-            lon=lons,
+            lat=colegios_area["y"].to_numpy(dtype=np.float32),
+            lon=colegios_area["x"].to_numpy(dtype=np.float32),
             mode='markers',
             name='Colegios',
             marker=dict(
@@ -559,14 +654,14 @@ elif st.session_state.step == 5:
                 opacity=0.88,
                 symbol='circle'
             ),
-            text=nombres_colegios,  # Usar nombres reales
+            text=colegios_area["nombre"],  # Usar nombres reales
             hoverinfo='text'
         ))
 
     # Punto central seleccionado por el usuario (azul estándar del flujo)
     fig_educacion.add_trace(go.Scattermapbox(
-        lat=[st.session_state.punto_lat],
-        lon=[st.session_state.punto_lon],
+        lat=[lat],
+        lon=[lon],
         mode='markers',
         name='Punto de interés',
         marker=dict(
@@ -577,88 +672,49 @@ elif st.session_state.step == 5:
 
     fig_educacion.update_layout(
         mapbox_style="carto-positron",
-        mapbox_center={"lat": st.session_state.punto_lat, "lon": st.session_state.punto_lon},
+        mapbox_center={"lat": lat, "lon": lon},
         mapbox_zoom=14,
         margin={"r": 0, "t": 40, "l": 0, "b": 0},
         title=f"Centros educativos en el entorno ({len(colegios_area)} colegios)",
         showlegend=True,
         height=600
     )
+    return fig_educacion
 
-    st.plotly_chart(fig_educacion, use_container_width=True)
 
-    # Métricas profesionalizadas
-    col1, col2 = st.columns(2)
-    with col1:
-        st.metric("Colegios en el entorno", len(colegios_area))
-    with col2:
-        if colegios_area:
-            densidad = len(colegios_area) / (3.14159 * (st.session_state.radio_analisis / 1000) ** 2)
-            st.metric("Densidad educativa\n (por km²)", f"{densidad:.2f}")
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_estrato(lat, lon, radio, cod_localidad, _diagnostico):
+    """Mapa de manzanas coloreadas por estrato"""
+    borde_lat, borde_lon = _diagnostico["borde_lat"], _diagnostico["borde_lon"]
+    manzanas_zona = _diagnostico["manzanas_zona"]
+    dist_estratos = _diagnostico["dist_estratos"]
 
-        # ========================================
-    # VISUALIZACIÓN: COMPOSICIÓN SOCIOECONÓMICA (ESTRATO)
-    # ========================================
-    st.markdown("""
-    ### 🏘️ Composición Socioeconómica en el Entorno
-
-    En este mapa exploramos cómo se distribuyen los diferentes estratos socioeconómicos dentro del área de análisis seleccionada.
-    Cada polígono corresponde a una manzana urbana y el color representa el estrato predominante en cada una, ayudando a visualizar la diversidad y estructura social del sector.
-
-    La leyenda te ayudará a identificar rápidamente cómo se organiza el tejido urbano alrededor de tu punto de interés.
-    """)
-
-    # Colores consistentes para cada estrato
-    estratos_unicos = sorted(manzanas_zona["estrato"].unique())
-    color_estrato = {
-        1: '#8B0000',  # Rojo oscuro
-        2: '#FF4500',  # Rojo naranja
-        3: '#FFD700',  # Dorado
-        4: '#90EE90',  # Verde claro
-        5: '#4169E1',  # Azul real
-        6: '#9370DB'   # Púrpura medio
-    }
-
-    fig_estrato = go.Figure()
+    fig_estrato = go.Figure()
 
     # Marco del área de análisis (naranja uniforme con el resto)
     fig_estrato.add_trace(go.Scattermapbox(
-        lat=list(area_wgs.exterior.xy[1]),
-        lon=list(area_wgs.exterior.xy[0]),
+        lat=borde_lat,
+        lon=borde_lon,
         mode='lines',
-        name=f'Área de análisis ({st.session_state.radio_analisis}m)',
+        name=f'Área de análisis ({radio}m)',
         line=dict(color='orange', width=2),
         showlegend=False
     ))
 
-    # Agrupa y pinta las manzanas por estrato, leyenda compacta
-    trazas_agregadas = set()
-    for estrato in estratos_unicos:
-        manzanas_estrato = manzanas_zona[manzanas_zona["estrato"] == estrato]
-        for idx, (_, manzana) in enumerate(manzanas_estrato.iterrows()):
-            if manzana.geometry.geom_type == 'Polygon':
-                coords = list(manzana.geometry.exterior.coords)
-                mostrar_leyenda = estrato not in trazas_agregadas
-                if mostrar_leyenda:
-                    trazas_agregadas.add(estrato)
-                fig_estrato.add_trace(go.Scattermapbox(
-                    lat=[c[1] for c in coords],
-                    lon=[c[0] for c in coords],
-                    mode='lines',
-                    fill='toself',
-                    fillcolor=color_estrato.get(estrato, '#808080'),
-                    line=dict(color='black', width=0.5),
-                    name=f'Estrato {estrato}',
-                    showlegend=mostrar_leyenda,
-                    legendgroup=f'estrato_{estrato}',
-                    hovertext=f'Estrato {estrato}',
-                    hoverinfo='text'
-                ))
+    # Una traza coroplética por estrato (no una por manzana), leyenda compacta
+    # dist_estratos ya trae los estratos de la zona, ordenados
+    for estrato in dist_estratos.index:
+        fig_estrato.add_trace(capa_manzanas(
+            manzanas_zona[manzanas_zona["estrato"] == estrato],
+            f'Estrato {estrato}',
+            COLOR_ESTRATO.get(estrato, '#808080'),
+            f'estrato_{estrato}'
+        ))
 
     # Punto central uniformado
     fig_estrato.add_trace(go.Scattermapbox(
-        lat=[st.session_state.punto_lat],
-        lon=[st.session_state.punto_lon],
+        lat=[lat],
+        lon=[lon],
         mode='markers',
         name='Punto de interés',
         marker=dict(
@@ -670,7 +726,7 @@ elif st.session_state.step == 5:
 
     fig_estrato.update_layout(
         mapbox_style="carto-positron",
-        mapbox_center={"lat": st.session_state.punto_lat, "lon": st.session_state.punto_lon},
+        mapbox_center={"lat": lat, "lon": lon},
         mapbox_zoom=14,
         margin={"r": 0, "t": 40, "l": 0, "b": 0},
         title="Distribución de estratos socioeconómicos",
@@ -684,103 +740,66 @@ elif st.session_state.step == 5:
             bgcolor="rgba(255, 255, 255, 0.8)"
         )
     )
-
-    st.plotly_chart(fig_estrato, use_container_width=True)
-
-    # Distribución gráfica y numérica (profesional)
-    st.markdown("**Resumen visual de estratos en el entorno:**")
-    dist_estratos = manzanas_zona["estrato"].value_counts().sort_index()
-    col1, col2 = st.columns([1, 1])
-    with col1:
-        for estrato, cantidad in dist_estratos.items():
-            porcentaje = cantidad / len(manzanas_zona) * 100
-            st.write(f"- Estrato {estrato}: {cantidad} manzanas ({porcentaje:.1f}%)")
-    with col2:
-        fig_estratobarras = go.Figure(data=[
-            go.Bar(
-                x=[f"E{e}" for e in dist_estratos.index],
-                y=dist_estratos.values,
-                marker_color=[color_estrato.get(e, '#808080') for e in dist_estratos.index],
-                text=dist_estratos.values,
-                textposition='auto',
-            )
-        ])
-        fig_estratobarras.update_layout(
-            title="Cantidad de manzanas por estrato",
-            xaxis_title="Estrato",
-            yaxis_title="Cantidad",
-            height=300,
-            margin=dict(l=20, r=20, t=40, b=20)
+    return fig_estrato
+
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_estrato_barras(lat, lon, radio, cod_localidad, _diagnostico):
+    """Barras con la cantidad de manzanas por estrato"""
+    dist_estratos = _diagnostico["dist_estratos"]
+    fig_estratobarras = go.Figure(data=[
+        go.Bar(
+            x=[f"E{e}" for e in dist_estratos.index],
+            y=dist_estratos.values,
+            marker_color=[COLOR_ESTRATO.get(e, '#808080') for e in dist_estratos.index],
+            text=dist_estratos.values,
+            textposition='auto',
         )
-        st.plotly_chart(fig_estratobarras, use_container_width=True)
-
-        # ========================================
-    # VISUALIZACIÓN: USO DEL SUELO SEGÚN PLAN DE ORDENAMIENTO TERRITORIAL (POT)
-    # ========================================
-    st.markdown("""
-    ### 🗺️ Distribución de Usos del Suelo (POT)
+    ])
+    fig_estratobarras.update_layout(
+        title="Cantidad de manzanas por estrato",
+        xaxis_title="Estrato",
+        yaxis_title="Cantidad",
+        height=300,
+        margin=dict(l=20, r=20, t=40, b=20)
+    )
+    return fig_estratobarras
 
-    Este mapa te permite entender cómo están organizados los usos del suelo dentro del área de análisis, según la planificación oficial de Bogotá (POT).
-    Cada color corresponde a una categoría de uso (residencial, dotacional, comercial, servicios, etc.), facilitando la identificación de zonas homogéneas, mixtas o de oportunidad.
 
-    Observa la composición y diversificación del entorno alrededor de tu punto de interés.
-    """)
-
-    # Unificar con áreas POT de la zona y asignar colores
-    if "id_area" in manzanas_zona.columns and not areas.empty:
-        manzanas_pot = manzanas_zona.merge(
-            areas[["id_area", "uso_pot_simplificado"]],
-            on="id_area",
-            how="left"
-        )
-        manzanas_pot["uso_pot_simplificado"] = manzanas_pot["uso_pot_simplificado"].fillna("Sin clasificación")
-    else:
-        manzanas_pot = manzanas_zona.copy()
-        manzanas_pot["uso_pot_simplificado"] = "Sin clasificación"
-
-    usos_pot = sorted(manzanas_pot["uso_pot_simplificado"].unique())
-    palette_pot = px.colors.qualitative.Plotly
-    color_pot_map = {uso: palette_pot[i % len(palette_pot)] for i, uso in enumerate(usos_pot)}
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_pot(lat, lon, radio, cod_localidad, _diagnostico, _colores_pot):
+    """Mapa de manzanas coloreadas por uso del suelo POT"""
+    borde_lat, borde_lon = _diagnostico["borde_lat"], _diagnostico["borde_lon"]
+    manzanas_pot = _diagnostico["manzanas_pot"]
+    # Colores globales de los usos POT; usos presentes en la zona
+    color_pot_map = _colores_pot
+    usos_pot = sorted(_diagnostico["dist_pot"].index)
 
     fig_pot = go.Figure()
 
     # Marco de área de análisis uniforme
     fig_pot.add_trace(go.Scattermapbox(
-        lat=list(area_wgs.exterior.xy[1]),
-        lon=list(area_wgs.exterior.xy[0]),
+        lat=borde_lat,
+        lon=borde_lon,
         mode='lines',
         name='Área de análisis',
         line=dict(color='orange', width=2),
         showlegend=False
     ))
 
-    trazas_agregadas_pot = set()
+    # Una traza coroplética por uso del suelo
     for uso in usos_pot:
-        manzanas_uso = manzanas_pot[manzanas_pot["uso_pot_simplificado"] == uso]
-        for idx, (_, manzana) in enumerate(manzanas_uso.iterrows()):
-            if manzana.geometry.geom_type == 'Polygon':
-                coords = list(manzana.geometry.exterior.coords)
-                mostrar_leyenda = uso not in trazas_agregadas_pot
-                if mostrar_leyenda:
-                    trazas_agregadas_pot.add(uso)
-                fig_pot.add_trace(go.Scattermapbox(
-                    lat=[c[1] for c in coords],
-                    lon=[c[0] for c in coords],
-                    mode='lines',
-                    fill='toself',
-                    fillcolor=color_pot_map.get(uso, '#808080'),
-                    line=dict(color='black', width=0.5),
-                    name=uso,
-                    showlegend=mostrar_leyenda,
-                    legendgroup=f'pot_{uso}',
-                    hovertext=uso,
-                    hoverinfo='text'
-                ))
+        fig_pot.add_trace(capa_manzanas(
+            manzanas_pot[manzanas_pot["uso_pot_simplificado"] == uso],
+            uso,
+            color_pot_map.get(uso, '#808080'),
+            f'pot_{uso}'
+        ))
 
     # Punto central (azul uniforme)
     fig_pot.add_trace(go.Scattermapbox(
-        lat=[st.session_state.punto_lat],
-        lon=[st.session_state.punto_lon],
+        lat=[lat],
+        lon=[lon],
         mode='markers',
         name='Punto de interés',
         marker=dict(
@@ -792,7 +811,7 @@ elif st.session_state.step == 5:
 
     fig_pot.update_layout(
         mapbox_style="carto-positron",
-        mapbox_center={"lat": st.session_state.punto_lat, "lon": st.session_state.punto_lon},
+        mapbox_center={"lat": lat, "lon": lon},
         mapbox_zoom=14,
         margin={"r": 0, "t": 40, "l": 0, "b": 0},
         title="Distribución de usos del suelo según el POT",
@@ -806,34 +825,347 @@ elif st.session_state.step == 5:
             bgcolor="rgba(255, 255, 255, 0.8)"
         )
     )
+    return fig_pot
+
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def figura_pot_barras(lat, lon, radio, cod_localidad, _diagnostico, _colores_pot):
+    """Barras con la cantidad de manzanas por uso POT"""
+    dist_pot = _diagnostico["dist_pot"]
+    color_pot_map = _colores_pot
+    fig_pot_barras = go.Figure(data=[
+        go.Bar(
+            x=[uso[:20] + '...' if len(uso) > 20 else uso for uso in dist_pot.index],
+            y=dist_pot.values,
+            marker_color=[color_pot_map.get(uso, '#808080') for uso in dist_pot.index],
+            text=dist_pot.values,
+            textposition='auto',
+        )
+    ])
+    fig_pot_barras.update_layout(
+        title="Cantidad de manzanas por uso POT",
+        xaxis_title="Uso del suelo",
+        yaxis_title="Cantidad",
+        height=300,
+        margin=dict(l=20, r=20, t=40, b=20)
+    )
+    return fig_pot_barras
+
+# --- Navegación entre pasos ---
+# Callbacks de los botones: el estado cambia antes del rerun que provoca el
+# clic, sin un segundo rerun completo con st.rerun()
+def ir_a_paso(paso):
+    """Cambia el paso activo"""
+    st.session_state.step = paso
+
+
+def construir_indices(dataframes):
+    """Prepara los índices espaciales de la sesión (se ejecuta en segundo plano)"""
+    # Índices espaciales construidos una sola vez por sesión: localidades
+    # para el clic del paso 2 y manzanas para el paso 5. No sobreviven al
+    # pickle de la caché, por eso se construyen aquí y no al cargar
+    for nombre in ("localidades", "manzanas_m"):
+        _ = dataframes[nombre].sindex
+    # Polígonos de localidad preparados para las pruebas de pertenencia
+    shapely.prepare(dataframes["localidades"].geometry.values)
+
+
+def iniciar_diagnostico(dataframes, hilo_indices):
+    """Guarda los datasets en la sesión y pasa a la selección de localidad"""
+    # Una sola referencia al diccionario cacheado, sin copiar cada capa
+    st.session_state.datasets = dataframes
+    # Normalmente los índices ya están listos mientras el usuario leía el paso 1
+    hilo_indices.join()
+    st.session_state.step = 2
+
+
+def nuevo_analisis():
+    """Limpia el análisis pero mantiene los datasets y vuelve a la selección de localidad"""
+    keys_to_keep = ["datasets"]
+    keys_to_delete = [k for k in st.session_state.keys() if k not in keys_to_keep]
+    for key in keys_to_delete:
+        del st.session_state[key]
+    st.session_state.step = 2
+
+# --- Inicialización del estado ---
+if "step" not in st.session_state:
+    st.session_state.step = 1
+
+# ========================================
+# PASO 1: CARGA DE DATOS
+# ========================================
+if st.session_state.step == 1:
+    st.markdown("""
+    ### 🚦 Punto de partida: Activando el diagnóstico urbano
+
+    Antes de comenzar, el sistema recopila y verifica los datos esenciales de la ciudad para tu análisis.
+    Este proceso conectará fuentes oficiales y consolidará información geoespacial clave para que tu exploración territorial sea sólida y confiable.
+    """)
+    
+    st.info(
+        "🔄 **Preparando el escenario digital:**\n\n"
+        "En segundos tendrás acceso a la radiografía inteligente de Bogotá, utilizando fuentes oficiales de datos abiertos urbanísticos."
+    )
+
+    # Usar spinner para indicar proceso de carga
+    with st.spinner('⏳ Conectando y descargando los datasets urbanos...'):
+        try:
+            dataframes = cargar_datasets()
+        except Exception as e:
+            st.error(f"❌ Error al cargar los datos: {e}")
+            st.stop()
+
+    if dataframes:
+        st.success('✅ Datos cargados exitosamente. ¡Listo para iniciar tu análisis!')
+        # Los índices se construyen mientras el usuario lee la introducción
+        hilo_indices = threading.Thread(target=construir_indices, args=(dataframes,), daemon=True)
+        hilo_indices.start()
+        st.button("🔍 Empezar diagnóstico", on_click=iniciar_diagnostico, args=(dataframes, hilo_indices))
+    else:
+        st.error("❌ Ocurrió un problema al cargar los datos. Verifica tu conexión o inténtalo nuevamente en unos minutos.")
+
+
+# ========================================
+# PASO 2: SELECCIÓN DE LOCALIDAD
+# ========================================
+elif st.session_state.step == 2:
+    st.header("🌆 Paso 1: Selecciona tu Localidad de Interés")
+
+    st.markdown("""
+    **¿Dónde comienza tu análisis?**
+    Haz clic sobre la localidad de Bogotá que deseas explorar. El sistema te mostrará un mapa interactivo con límites administrativos oficiales.
+    El color azul suave resalta el área elegida; al pasar el mouse, el borde rojo reforzará tu selección. Toda la plataforma mantiene un estilo gráfico uniforme para garantizar claridad y profesionalismo.
+    """)
+
+    localidades = st.session_state.datasets["localidades"]
+
+    # Crear mapa interactivo con Folium (reutilizado por el fragmento entre clics)
+    center = calcular_centro("localidades", localidades.geometry.values)
+    # Geometría simplificada para el mapa; el clic se resuelve sobre la original
+    mapa = construir_mapa_localidades(
+        serializar_geojson("localidades", simplificar_localidades(localidades)), center
+    )
+
+    fragmento_mapa_localidades(mapa, localidades)
+
+    st.markdown("---")
+    st.button("🔄 Volver al Inicio", on_click=ir_a_paso, args=(1,))
+
+
+# ========================================
+# PASO 3: DEFINIR ÁREA DE INFLUENCIA
+# ========================================
+elif st.session_state.step == 3:
+    st.header("📏 Paso 2: Define el radio de tu análisis urbano")
+
+    st.markdown(f"""
+    **Localidad seleccionada:** `{st.session_state.localidad_sel}`  
+    
+    El radio de análisis determina el área de influencia que se estudiará alrededor del punto que escojas en el mapa.
+    Decide qué tan amplio quieres que sea tu contexto urbano y ajusta el valor en metros para comparar sectores de forma homogénea.
+    """)
+
+    # Saltos de 300 en 300 para mejor usabilidad mobile/desktop
+    radio_analisis = st.slider(
+        "Selecciona el radio de análisis (metros)",
+        min_value=300,
+        max_value=2100,
+        value=600,
+        step=300,
+        help="Entre más grande el radio, más contexto y servicios urbanos tendrás en el análisis."
+    )
+    st.session_state.radio_analisis = radio_analisis
+
+    st.info(f"🟠 El análisis incluirá una zona de **{radio_analisis} metros** alrededor del punto que selecciones en el siguiente paso.")
+
+    # Botones de navegación
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("🔙 Volver a selección de localidad", on_click=ir_a_paso, args=(2,))
+    with col2:
+        st.button("➡️ Continuar", on_click=ir_a_paso, args=(4,))
+
+
+# ========================================
+# PASO 4: SELECCIÓN DE PUNTO DE INTERÉS
+# ========================================
+elif st.session_state.step == 4:
+    st.header("📍 Paso 3: Selecciona el punto sobre el cual analizarás el entorno")
+
+    st.markdown(f"""
+    **Localidad elegida:** `{st.session_state.localidad_sel}`  
+    **Radio de análisis:** `{st.session_state.radio_analisis} metros`
+
+    Haz clic directamente sobre la zona que deseas estudiar en detalle. 
+    El sistema aplicará el radio seleccionado para analizar el entorno urbano alrededor del punto que escojas.
+    """)
+
+    localidades = st.session_state.datasets["localidades"]
+
+    # Filtrar por localidad seleccionada: búsqueda directa en el diccionario
+    cod_localidad, posicion = indice_localidades(localidades)[st.session_state.localidad_sel]
+    localidad_geo = simplificar_localidades(localidades).iloc[[posicion]]
+
+    # Crear mapa con cursor cruz (reutilizado por el fragmento entre clics)
+    center = calcular_centro(f"localidad_{cod_localidad}", localidades.geometry.iloc[posicion])
+    mapa = construir_mapa_punto(
+        serializar_geojson(f"localidad_{cod_localidad}", localidad_geo), center
+    )
+
+    fragmento_mapa_punto(mapa)
+
+    st.markdown("---")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("🔙 Volver al paso anterior", use_container_width=True, on_click=ir_a_paso, args=(3,))
+    with col2:
+        st.button("🔄 Reiniciar análisis", use_container_width=True, on_click=ir_a_paso, args=(1,))
+
+# ========================================
+# PASO 5: GENERACIÓN DE MAPAS Y ANÁLISIS
+# ========================================
+elif st.session_state.step == 5:
+    st.header("📊 Diagnóstico Urbano Completo")
+
+    punto_lat, punto_lon = st.session_state.punto
+
+    st.markdown(f"""
+    <b>Localidad seleccionada:</b> {st.session_state.localidad_sel}  
+    <b>Radio de análisis:</b> {st.session_state.radio_analisis} metros  
+    <b>Punto de interés:</b> Lat {punto_lat:.6f}, Lon {punto_lon:.6f}
+
+    La herramienta generará visualizaciones y métricas que describen el entorno urbano alrededor del punto elegido. Analiza la densidad, acceso a servicios y el contexto socioespacial de la zona seleccionada.
+    """, unsafe_allow_html=True)
+
+    # Cargar datos
+    localidades = st.session_state.datasets["localidades"]
+    manzanas = st.session_state.datasets["manzanas"]
+    localidades_m = st.session_state.datasets["localidades_m"]
+    manzanas_m = st.session_state.datasets["manzanas_m"]
+    transporte_pts = st.session_state.datasets["transporte_pts"]
+    colegios_pts = st.session_state.datasets["colegios_pts"]
+    areas = st.session_state.datasets["areas"]
+
+    # Obtener código de localidad
+    cod_localidad, _ = indice_localidades(localidades)[st.session_state.localidad_sel]
+
+    # Diagnóstico cacheado: los reruns con el mismo punto, radio y localidad
+    # no repiten buffer ni consultas espaciales
+    diagnostico = calcular_diagnostico(
+        punto_lat,
+        punto_lon,
+        st.session_state.radio_analisis,
+        cod_localidad,
+        manzanas, manzanas_m, transporte_pts, colegios_pts, areas
+    )
+    manzanas_zona = diagnostico["manzanas_zona"]
+    estaciones_area = diagnostico["estaciones_area"]
+    colegios_area = diagnostico["colegios_area"]
+    manzanas_pot = diagnostico["manzanas_pot"]
+    dist_estratos = diagnostico["dist_estratos"]
+    dist_pot = diagnostico["dist_pot"]
+
+    # ========================================
+    # VISUALIZACIÓN: MAPA DE ESTACIONES DE TRANSPORTE
+    # ========================================
+    st.markdown("""
+    ### 🚇 Accesibilidad en Transporte Público
+
+    En este mapa puedes visualizar todas las estaciones de transporte público dentro del área de análisis determinada. 
+    Cada punto rojo representa una estación disponible alrededor del punto seleccionado, ayudándote a entender la conectividad y accesibilidad de la zona.
+
+    El área sombreada muestra el alcance del entorno estudiado, manteniendo la uniformidad estética en todos los mapas y métricas urbanas.
+    """)
+
+    fig_transporte = figura_transporte(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico)
+    st.plotly_chart(fig_transporte, use_container_width=True)
+
+    # Métricas visuales uniformes
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Estaciones en el entorno", len(estaciones_area))
+    with col2:
+        if not estaciones_area.empty:
+            densidad = len(estaciones_area) / (3.14159 * (st.session_state.radio_analisis / 1000) ** 2)
+            st.metric("Densidad de estaciones\n (por km²)", f"{densidad:.2f}")
+
+
+    # ========================================
+    # VISUALIZACIÓN: MAPA DE CENTROS EDUCATIVOS
+    # ========================================
+    st.markdown("""
+    ### 🏫 Oferta Educativa en el Entorno
+
+    Visualiza todos los centros educativos dentro del área de análisis que seleccionaste. 
+    Cada punto morado representa la ubicación de un colegio disponible para la comunidad, facilitando la evaluación de acceso educativo y nivel de cobertura del sector.
+
+    El área sombreada corresponde a los metros de radio definidos, manteniendo la uniformidad visual en toda la plataforma.
+    """)
+
+    fig_educacion = figura_colegios(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico)
+    st.plotly_chart(fig_educacion, use_container_width=True)
+
+    # Métricas profesionalizadas
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Colegios en el entorno", len(colegios_area))
+    with col2:
+        if not colegios_area.empty:
+            densidad = len(colegios_area) / (3.14159 * (st.session_state.radio_analisis / 1000) ** 2)
+            st.metric("Densidad educativa\n (por km²)", f"{densidad:.2f}")
 
+        # ========================================
+    # VISUALIZACIÓN: COMPOSICIÓN SOCIOECONÓMICA (ESTRATO)
+    # ========================================
+    st.markdown("""
+    ### 🏘️ Composición Socioeconómica en el Entorno
+
+    En este mapa exploramos cómo se distribuyen los diferentes estratos socioeconómicos dentro del área de análisis seleccionada.
+    Cada polígono corresponde a una manzana urbana y el color representa el estrato predominante en cada una, ayudando a visualizar la diversidad y estructura social del sector.
+
+    La leyenda te ayudará a identificar rápidamente cómo se organiza el tejido urbano alrededor de tu punto de interés.
+    """)
+
+    fig_estrato = figura_estrato(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico)
+    st.plotly_chart(fig_estrato, use_container_width=True)
+
+    # Distribución gráfica y numérica (profesional)
+    st.markdown("**Resumen visual de estratos en el entorno:**")
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        for estrato, cantidad in dist_estratos.items():
+            porcentaje = cantidad / len(manzanas_zona) * 100
+            st.write(f"- Estrato {estrato}: {cantidad} manzanas ({porcentaje:.1f}%)")
+    with col2:
+        fig_estratobarras = figura_estrato_barras(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico)
+        st.plotly_chart(fig_estratobarras, use_container_width=True)
+
+        # ========================================
+    # VISUALIZACIÓN: USO DEL SUELO SEGÚN PLAN DE ORDENAMIENTO TERRITORIAL (POT)
+    # ========================================
+    st.markdown("""
+    ### 🗺️ Distribución de Usos del Suelo (POT)
+
+    Este mapa te permite entender cómo están organizados los usos del suelo dentro del área de análisis, según la planificación oficial de Bogotá (POT).
+    Cada color corresponde a una categoría de uso (residencial, dotacional, comercial, servicios, etc.), facilitando la identificación de zonas homogéneas, mixtas o de oportunidad.
+
+    Observa la composición y diversificación del entorno alrededor de tu punto de interés.
+    """)
+
+    # Colores globales de los usos POT
+    color_pot_map = obtener_colores_pot(areas)
+    fig_pot = figura_pot(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico, color_pot_map)
     st.plotly_chart(fig_pot, use_container_width=True)
 
     # Distribución visual y texto
     st.markdown("**Resumen de usos del suelo en el área de análisis:**")
-    dist_pot = manzanas_pot["uso_pot_simplificado"].value_counts()
     col1, col2 = st.columns([1, 1])
     with col1:
         for uso, cantidad in dist_pot.items():
             porcentaje = cantidad / len(manzanas_pot) * 100
             st.write(f"- {uso}: {cantidad} manzanas ({porcentaje:.1f}%)")
     with col2:
-        fig_pot_barras = go.Figure(data=[
-            go.Bar(
-                x=[uso[:20] + '...' if len(uso) > 20 else uso for uso in dist_pot.index],
-                y=dist_pot.values,
-                marker_color=[color_pot_map.get(uso, '#808080') for uso in dist_pot.index],
-                text=dist_pot.values,
-                textposition='auto',
-            )
-        ])
-        fig_pot_barras.update_layout(
-            title="Cantidad de manzanas por uso POT",
-            xaxis_title="Uso del suelo",
-            yaxis_title="Cantidad",
-            height=300,
-            margin=dict(l=20, r=20, t=40, b=20)
-        )
+        fig_pot_barras = figura_pot_barras(punto_lat, punto_lon, st.session_state.radio_analisis, cod_localidad, diagnostico, color_pot_map)
         st.plotly_chart(fig_pot_barras, use_container_width=True)
 
         
@@ -843,77 +1175,28 @@ elif st.session_state.step == 5:
     st.markdown("---")
     st.markdown("### 📋 Informe Automatizado de Diagnóstico Territorial")
     
-    # Calcular datos de la localidad completa
-    manzanas_localidad = manzanas[manzanas["num_localidad"] == cod_localidad]
-    
-    # Contar estaciones totales en la localidad
-    estaciones_localidad = []
-    for _, row in transporte.iterrows():
-        if hasattr(row["geometry"], "geoms"):
-            for pt in row["geometry"].geoms:
-                # Verificar si el punto está en alguna manzana de la localidad
-                for _, manzana in manzanas_localidad.iterrows():
-                    if manzana.geometry.contains(pt):
-                        estaciones_localidad.append(pt)
-                        break
-    
-    # Contar colegios totales en la localidad
-    colegios_localidad = []
-    for _, row in colegios.iterrows():
-        if hasattr(row["geometry"], "geoms"):
-            for pt in row["geometry"].geoms:
-                for _, manzana in manzanas_localidad.iterrows():
-                    if manzana.geometry.contains(pt):
-                        colegios_localidad.append(pt)
-                        break
-    
-    total_estaciones_loc = len(set([(pt.x, pt.y) for pt in estaciones_localidad]))
-    total_colegios_loc = len(set([(pt.x, pt.y) for pt in colegios_localidad]))
-    
-    # Calcular porcentajes
-    porcentaje_estaciones = (len(estaciones_buffer) / total_estaciones_loc * 100) if total_estaciones_loc > 0 else 0
-    porcentaje_colegios = (len(colegios_buffer) / total_colegios_loc * 100) if total_colegios_loc > 0 else 0
-    
-    # Generar informe
-    st.markdown(f"""
-    #### Resumen Ejecutivo
-    
-    **Localidad Analizada:** {st.session_state.localidad_sel}  
-    **Radio de Análisis:** {st.session_state.buffer_size} metros  
-    **Coordenadas del Punto:** {st.session_state.punto_lat:.6f}, {st.session_state.punto_lon:.6f}
-    
-    ---
-    
-    #### 🏘️ Análisis de Manzanas
-    - **Total de manzanas en el buffer:** {len(manzanas_buffer)}
-    - **Estrato predominante:** {manzanas_buffer['estrato'].mode()[0] if not manzanas_buffer.empty else 'N/A'}
-    - **Uso del suelo predominante:** {dist_pot.index[0] if not dist_pot.empty else 'N/A'}
-    
-    #### 🚇 Análisis de Transporte
-    - **Estaciones en el buffer:** {len(estaciones_buffer)}
-    - **Total de estaciones en la localidad:** {total_estaciones_loc}
-    - **Representación:** {porcentaje_estaciones:.1f}% del total de la localidad
-    
-    **Diagnóstico:** {"✅ El sector cuenta con buena cobertura de transporte" if len(estaciones_buffer) >= 2 else "⚠️ El sector tiene cobertura limitada de transporte"}
-    
-    #### 🏫 Análisis Educativo
-    - **Colegios en el buffer:** {len(colegios_buffer)}
-    - **Total de colegios en la localidad:** {total_colegios_loc}
-    - **Representación:** {porcentaje_colegios:.1f}% del total de la localidad
-    
-    **Diagnóstico:** {"✅ El sector cuenta con buena oferta educativa" if len(colegios_buffer) >= 2 else "⚠️ El sector tiene oferta educativa limitada"}
-    
-    #### 📊 Evaluación General
-    """)
+    # Calcular datos de la localidad completa: cacheados por localidad, no
+    # cambian al mover el punto ni el radio
+    total_estaciones_loc, total_colegios_loc = totales_por_localidad(
+        cod_localidad, localidades_m, transporte_pts, colegios_pts
+    )
     
-    # Evaluación general
-    score = 0
-    if len(estaciones_buffer) >= 2:
-        score += 1
-    if len(colegios_buffer) >= 2:
-        score += 1
-    if len(manzanas_buffer) >= 10:
-        score += 1
+    # Generar informe: texto, puntaje y CSV se calculan una sola vez por análisis;
+    # los predominantes salen de los conteos ya calculados en el diagnóstico
+    texto_informe, score, csv_informe = generar_informe(
+        st.session_state.localidad_sel,
+        st.session_state.radio_analisis,
+        punto_lat,
+        punto_lon,
+        len(manzanas_zona),
+        dist_estratos.idxmax() if not dist_estratos.empty else 'N/A',
+        dist_pot.index[0] if not dist_pot.empty else 'N/A',
+        len(estaciones_area),
+        len(colegios_area),
+        total_estaciones_loc,
+        total_colegios_loc
+    )
+    st.markdown(texto_informe)
     
     if score == 3:
         st.success("✅ **SECTOR BIEN DOTADO** - El área analizada cuenta con buena disponibilidad de servicios y equipamientos urbanos.")
@@ -925,10 +1208,10 @@ elif st.session_state.step == 5:
     # Guardar datos para descarga
     st.session_state.informe_data = {
         "localidad": st.session_state.localidad_sel,
-        "buffer_size": st.session_state.buffer_size,
-        "manzanas": len(manzanas_buffer),
-        "estaciones": len(estaciones_buffer),
-        "colegios": len(colegios_buffer),
+        "buffer_size": st.session_state.radio_analisis,
+        "manzanas": len(manzanas_zona),
+        "estaciones": len(estaciones_area),
+        "colegios": len(colegios_area),
         "total_estaciones_loc": total_estaciones_loc,
         "total_colegios_loc": total_colegios_loc,
         "score": score
@@ -939,40 +1222,16 @@ elif st.session_state.step == 5:
     col1, col2, col3 = st.columns(3)
     
     with col1:
-        if st.button("🔙 Volver a Selección de Punto"):
-            st.session_state.step = 4
-            st.rerun()
+        st.button("🔙 Volver a Selección de Punto", on_click=ir_a_paso, args=(4,))
     
     with col2:
-        if st.button("📥 Descargar Informe"):
-            # Crear CSV con los datos
-            import csv
-            from io import StringIO
-            
-            csv_buffer = StringIO()
-            writer = csv.writer(csv_buffer)
-            writer.writerow(["Indicador", "Valor"])
-            writer.writerow(["Localidad", st.session_state.localidad_sel])
-            writer.writerow(["Buffer (m)", st.session_state.buffer_size])
-            writer.writerow(["Manzanas", len(manzanas_buffer)])
-            writer.writerow(["Estaciones", len(estaciones_buffer)])
-            writer.writerow(["Colegios", len(colegios_buffer)])
-            writer.writerow(["% Estaciones", f"{porcentaje_estaciones:.1f}"])
-            writer.writerow(["% Colegios", f"{porcentaje_colegios:.1f}"])
-            
-            st.download_button(
-                label="Descargar datos en CSV",
-                data=csv_buffer.getvalue(),
-                file_name=f"informe_{st.session_state.localidad_sel}_{st.session_state.buffer_size}m.csv",
-                mime="text/csv"
-            )
+        # El CSV ya viene cacheado con el informe: descarga directa en un clic
+        st.download_button(
+            label="📥 Descargar Informe",
+            data=csv_informe,
+            file_name=f"informe_{st.session_state.localidad_sel}_{st.session_state.radio_analisis}m.csv",
+            mime="text/csv"
+        )
     
     with col3:
-        if st.button("🔄 Nuevo Análisis"):
-            # Limpiar datos pero mantener datasets
-            keys_to_keep = ["localidades", "areas", "manzanas", "transporte", "colegios"]
-            keys_to_delete = [k for k in st.session_state.keys() if k not in keys_to_keep]
-            for key in keys_to_delete:
-                del st.session_state[key]
-            st.session_state.step = 2
-            st.rerun()
+        st.button("🔄 Nuevo Análisis", on_click=nuevo_analisis)